@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Benchmarks pigeon offline against a stubbed publisher. Results can be saved
+# as JSON and compared against a baseline saved from an earlier run.
+#
+# Usage: ./bin/benchmark.py [--output=FILE] [--baseline=FILE] [--threshold=PCT]
+#
+# Exits with 1 if any benchmark is slower than the baseline by more than the
+# threshold percent.
+
+import argparse
+import contextlib
+import datetime
+import gc
+import json
+import logging
+import os
+import sys
+import time
+
+
+# Insert build/ directory in sys.path so we can import pigeon
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.dirname(__file__)),
+        'build'
+    )
+)
+
+# Pigeon reads its configuration at import, but we never connect to anything
+for key, val in [('HOST', 'localhost'), ('PORT', '5672'), ('USER', 'benchmark'),
+                 ('QUEUE', 'normal'), ('PASSWORD', 'benchmark'),
+                 ('VIRTUAL_HOST', 'benchmark')]:
+    os.environ.setdefault('PIGEON_' + key, val)
+
+
+import pigeon  # noqa
+
+
+BATCH_SIZES = [1, 10, 100]
+
+QUEUE_SETS = [
+    'normal',
+    'normal,submitter,jimbob',
+    'normal,50:submitter,10:jimbob',
+]
+
+PRIORITIES = [(1, 10), (7, 5), (30, 1)]
+
+
+class StubConnection:
+    """Stands in for a pika connection and channel and drops everything published"""
+    def channel(self):
+        return self
+
+    def basic_publish(self, exchange, routing_key, body, properties):
+        pass
+
+    def close(self):
+        pass
+
+
+class NullStream:
+    """Stream that drops everything written to it"""
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+
+def build_stub_connection(host, port, virtual_host, user, password):
+    return StubConnection()
+
+
+def build_crash_id(i):
+    return '%03x07bd0-2d1c-4865-af09-80bc00180313' % (i % 4096)
+
+
+def build_event(num_records):
+    """Builds an S3 event with num_records accepted raw crash records"""
+    return {
+        'Records': [
+            {
+                'eventSource': 'aws:s3',
+                'eventName': 'ObjectCreated:Put',
+                's3': {
+                    'object': {
+                        'key': 'v2/raw_crash/%s/20180313/%s' % (crash_id[0:3], crash_id)
+                    },
+                    'bucket': {'name': 'dev_bucket'},
+                }
+            }
+            for crash_id in [build_crash_id(i) for i in range(num_records)]
+        ]
+    }
+
+
+def time_it(func, number, repeat):
+    """Returns the best CPU seconds per call of func over repeat runs of number calls"""
+    best = None
+    # Like timeit, keep garbage collection from adding noise to timings
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for i in range(repeat):
+            start = time.process_time()
+            for j in range(number):
+                func()
+            seconds = (time.process_time() - start) / number
+            if best is None or seconds < best:
+                best = seconds
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return best
+
+
+def queue_override(queue_spec):
+    return {'queue_specs': pigeon.parse_queue_specs(queue_spec)}
+
+
+def get_benchmarks():
+    """Returns list of (name, func, config overrides) tuples"""
+    crash_id = build_crash_id(0)
+    record = build_event(1)['Records'][0]
+    today = datetime.date(2018, 3, 20)
+
+    benchmarks = [
+        ('is_crash_id', lambda: pigeon.is_crash_id(crash_id), {}),
+        ('route_record', lambda: pigeon.route_record(record, 'dev_bucket'), {}),
+        ('parse_queue_specs', lambda: pigeon.parse_queue_specs(QUEUE_SETS[-1]), {}),
+        ('get_crash_id_sample', lambda: pigeon.get_crash_id_sample(crash_id), {}),
+        ('is_throttled', lambda: pigeon.is_throttled(50, 20), {}),
+        (
+            'get_crash_id_priority',
+            lambda: pigeon.get_crash_id_priority(crash_id, today, PRIORITIES),
+            {}
+        ),
+        ('statsd_incr', lambda: pigeon.statsd_incr('socorro.pigeon.accept', value=1), {}),
+        (
+            'statsd_incr.tags',
+            lambda: pigeon.statsd_incr('socorro.pigeon.route', tags=['route:default']),
+            {'env': 'benchmark'}
+        ),
+    ]
+
+    for queue_spec in QUEUE_SETS:
+        for batch_size in BATCH_SIZES:
+            event = build_event(batch_size)
+            benchmarks.append((
+                'handler[records=%d,queues=%s]' % (batch_size, queue_spec),
+                lambda event=event: pigeon.handler(event, None),
+                queue_override(queue_spec)
+            ))
+
+    event = build_event(BATCH_SIZES[-1])
+    overrides = dict(queue_override(QUEUE_SETS[-1]), throttle_mode=pigeon.THROTTLE_MODE_HASH)
+    benchmarks.append((
+        'handler[records=%d,queues=%s,throttle=hash]' % (BATCH_SIZES[-1], QUEUE_SETS[-1]),
+        lambda: pigeon.handler(event, None),
+        overrides
+    ))
+
+    benchmarks.append((
+        'handler[records=%d,queues=%s,priorities]' % (BATCH_SIZES[-1], QUEUE_SETS[1]),
+        lambda: pigeon.handler(event, None),
+        dict(queue_override(QUEUE_SETS[1]), priorities=PRIORITIES)
+    ))
+
+    for log_sample in [10, 0]:
+        benchmarks.append((
+            'handler[records=%d,log=summary,sample=%d]' % (BATCH_SIZES[-1], log_sample),
+            lambda: pigeon.handler(event, None),
+            {'log_mode': pigeon.LOG_MODE_SUMMARY, 'log_sample': log_sample}
+        ))
+
+    return benchmarks
+
+
+def run_benchmarks(budget):
+    """Runs all the benchmarks and returns dict of name -> seconds per call
+
+    :arg float budget: rough CPU seconds to spend on each repeat of each benchmark
+
+    """
+    results = {}
+    for name, func, overrides in get_benchmarks():
+        with pigeon.CONFIG.override(**overrides):
+            # Warm up and calibrate the number of calls per repeat to the budget
+            number = max(1, int(budget / max(time_it(func, 1, 3), 1e-7)))
+            results[name] = time_it(func, number, repeat=7)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Compares results against a baseline
+
+    Benchmarks that are only in the results or only in the baseline are
+    included with None for the missing seconds and percent change so they
+    get reported.
+
+    :arg dict results: name -> seconds per call
+    :arg dict baseline: name -> seconds per call
+    :arg float threshold: percent slower than baseline that's a regression
+
+    :returns: list of (name, seconds, baseline seconds, percent change, regressed) tuples
+
+    """
+    comparison = []
+    for name in sorted(set(results) | set(baseline)):
+        seconds = results.get(name)
+        base_seconds = baseline.get(name)
+        if seconds is None or base_seconds is None:
+            comparison.append((name, seconds, base_seconds, None, False))
+            continue
+
+        if base_seconds > 0:
+            change = (seconds - base_seconds) / base_seconds * 100
+        elif seconds > 0:
+            change = float('inf')
+        else:
+            change = 0.0
+        comparison.append((name, seconds, base_seconds, change, change > threshold))
+    return comparison
+
+
+def format_us(seconds):
+    if seconds is None:
+        return '%15s' % '-'
+    return '%12.3f us' % (seconds * 1e6)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--output',
+        help='file to save results to as JSON'
+    )
+    parser.add_argument(
+        '--baseline',
+        help='JSON results file from an earlier run to compare against'
+    )
+    parser.add_argument(
+        '--threshold', type=float, default=20.0,
+        help='percent slower than the baseline that fails (default 20)'
+    )
+    parser.add_argument(
+        '--budget', type=float, default=0.05,
+        help='rough CPU seconds to spend on each repeat of each benchmark'
+    )
+    args = parser.parse_args(argv)
+
+    pigeon.build_pika_connection = build_stub_connection
+
+    # Log lines still get formatted, but go nowhere
+    for handler in logging.getLogger('pigeon').handlers:
+        handler.stream = NullStream()
+
+    # Metrics lines still get printed, but go nowhere
+    with contextlib.redirect_stdout(NullStream()):
+        results = run_benchmarks(args.budget)
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump({'results': results}, fp, indent=2, sort_keys=True)
+
+    if not args.baseline:
+        for name, seconds in sorted(results.items()):
+            print('%-72s %12.3f us' % (name, seconds * 1e6))
+        return 0
+
+    with open(args.baseline, 'r') as fp:
+        baseline = json.load(fp)['results']
+
+    regressions = 0
+    unmatched = 0
+    comparison = compare(results, baseline, args.threshold)
+    for name, seconds, base_seconds, change, regressed in comparison:
+        if base_seconds is None:
+            note = '  NEW: not in baseline'
+        elif seconds is None:
+            note = '  MISSING: only in baseline'
+        elif regressed:
+            note = '  REGRESSION'
+        else:
+            note = ''
+        print('%-72s %s %s %8s%s' % (
+            name, format_us(seconds), format_us(base_seconds),
+            '-' if change is None else '%+.1f%%' % change, note
+        ))
+        regressions += regressed
+        unmatched += change is None
+
+    if unmatched:
+        print('WARNING: %d benchmarks are only in the results or the baseline and '
+              'were not compared' % unmatched)
+
+    if regressions:
+        print('FAIL: %d benchmarks regressed more than %s%%' % (regressions, args.threshold))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
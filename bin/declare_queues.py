@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Declares the RabbitMQ queues Pigeon publishes to as durable priority queues.
+#
+# RabbitMQ only honors message priorities in queues declared with the
+# x-max-priority argument and queue arguments can't be changed after the
+# queue is declared. Existing queues must be drained and deleted first.
+#
+# Note: Run this in the test container which has access to RabbitMQ.
+#
+# Usage: ./bin/declare_queues.py [--max-priority=N]
+
+import argparse
+import logging
+import os
+import sys
+
+
+# Insert build/ directory in sys.path so we can import pika
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.dirname(__file__)),
+        'build'
+    )
+)
+
+# Kill logging so we don't have to listen to Pigeon logging
+logging.basicConfig(level=logging.CRITICAL)
+logging.getLogger().disabled = True
+logging.getLogger('pigeon').disabled = True
+
+
+from pigeon import build_pika_connection, CONFIG  # noqa
+
+
+def get_queues():
+    """Returns list of (queuename, PublishPolicy) tuples for all configured queues
+
+    Queues published to through an exchange other than the default exchange
+    are skipped with a warning. For those, the queue name is a routing key and
+    the queues bound to the exchange need to be declared by hand.
+
+    """
+    specs = list(CONFIG.queue_specs)
+    for bucket, prefix, route in CONFIG.router.routes:
+        if route.queues is not None:
+            specs.extend(route.queues)
+
+    queues = []
+    for throttle, queue, policy in specs:
+        if policy.exchange != '':
+            print('WARNING: %s: skipping routing key for exchange %r; declare queues bound '
+                  'to the exchange by hand' % (queue, policy.exchange))
+            continue
+        queues.append((queue, policy))
+    return queues
+
+
+def main(argv):
+    queues = get_queues()
+
+    # Default to the highest priority pigeon is configured to publish with
+    priorities = [priority for max_age, priority in CONFIG.priorities]
+    priorities.extend([
+        policy.properties.priority for queue, policy in queues
+        if policy.properties.priority is not None
+    ])
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--max-priority', type=int, default=max(priorities, default=0),
+        help='the x-max-priority to declare queues with'
+    )
+    args = parser.parse_args(argv)
+
+    if args.max_priority < 1:
+        print('No priorities configured. Set PIGEON_PRIORITIES or pass --max-priority.')
+        return 1
+
+    conn = build_pika_connection(
+        CONFIG.host,
+        CONFIG.port,
+        CONFIG.virtual_host,
+        CONFIG.user,
+        CONFIG.password
+    )
+    channel = conn.channel()
+
+    for queue in sorted(set(queue for queue, policy in queues)):
+        channel.queue_declare(
+            queue=queue,
+            durable=True,
+            arguments={'x-max-priority': args.max_priority}
+        )
+        print('%s: declared with x-max-priority %d' % (queue, args.max_priority))
+
+    conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
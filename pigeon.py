@@ -5,7 +5,11 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 from base64 import b64decode
+from collections import Counter, namedtuple
 import contextlib
+import copy
+import datetime
+import json
 import logging
 import logging.config
 import os
@@ -32,6 +36,24 @@ DEFER = '1'
 
 NOVALUE = object()
 
+# Log modes: "record" logs every record; "summary" logs one summary per
+# invocation and a sample of records
+LOG_MODE_RECORD = 'record'
+LOG_MODE_SUMMARY = 'summary'
+
+# Maximum number of crash ids to include in the invocation summary
+SUMMARY_CRASH_IDS = 10
+
+# Counts in every invocation summary
+SUMMARY_COUNTS = [
+    'records', 'ignored', 'deferred', 'accepted', 'throttled', 'published'
+]
+
+# Throttle modes: "random" samples each crash for each queue independently;
+# "hash" samples each crash once based on its crash id
+THROTTLE_MODE_RANDOM = 'random'
+THROTTLE_MODE_HASH = 'hash'
+
 
 logging.config.dictConfig({
     'version': 1,
@@ -68,28 +90,270 @@ logger = logging.getLogger('pigeon')
 logger.setLevel(logging.DEBUG)
 
 
-def parse_queues(val):
-    """Takes a string and converts it to a list of (queuename, throttle) tuples
+# Publish policy for a queue: the exchange to publish to and the precomputed
+# pika.BasicProperties to publish with
+PublishPolicy = namedtuple('PublishPolicy', ['exchange', 'properties'])
+
+DEFAULT_PUBLISH_POLICY = PublishPolicy(
+    exchange='',
+    properties=pika.BasicProperties(delivery_mode=2)
+)
+
+DELIVERY_MODES = {
+    '1': 1,
+    'transient': 1,
+    '2': 2,
+    'persistent': 2,
+}
+
+
+def parse_publish_policy(options):
+    """Takes a list of "key=value" strings and converts it to a PublishPolicy
+
+    Valid keys are ``delivery_mode`` (``1``/``transient`` or
+    ``2``/``persistent``), ``expiration`` (milliseconds), ``priority`` (0
+    through 255), and ``exchange``.
+
+    :arg list options: list of "key=value" strings
+
+    :returns: PublishPolicy
+
+    :raises ValueError: if an option is malformed or unknown
+
+    """
+    if not options:
+        return DEFAULT_PUBLISH_POLICY
+
+    exchange = DEFAULT_PUBLISH_POLICY.exchange
+    props = {'delivery_mode': 2}
+    for option in options:
+        if '=' not in option:
+            raise ValueError('%r is not a key=value queue option' % option)
+        key, value = [part.strip() for part in option.split('=', 1)]
+
+        if key == 'delivery_mode':
+            if value not in DELIVERY_MODES:
+                raise ValueError('%r is not a valid delivery_mode' % value)
+            props['delivery_mode'] = DELIVERY_MODES[value]
+        elif key == 'expiration':
+            expiration = int(value)
+            if expiration < 0:
+                raise ValueError('%r is not a valid expiration' % value)
+            # AMQP wants expiration as a string of milliseconds
+            props['expiration'] = str(expiration)
+        elif key == 'priority':
+            priority = int(value)
+            if not 0 <= priority <= 255:
+                raise ValueError('%r is not a valid priority' % value)
+            props['priority'] = priority
+        elif key == 'exchange':
+            exchange = value
+        else:
+            raise ValueError('%r is not a valid queue option' % key)
+
+    return PublishPolicy(exchange=exchange, properties=pika.BasicProperties(**props))
+
+
+def parse_queue_specs(val):
+    """Takes a string and converts it to a list of (throttle, queuename, policy) tuples
+
+    Each queue spec has the form ``[THROTTLE:]QUEUE[;KEY=VALUE...]``.
 
     :arg str val: the configuration value
 
-    :returns: list of (throttle, queuename) tuples
+    :returns: list of (throttle, queuename, PublishPolicy) tuples
 
     """
     # Split the value on , and drop any pre/post whitespace
     val = [part.strip() for part in val.split(',')]
 
-    # For each thing, if there's a :, then the first part is the throttle as an
-    # int and the second part is the queue name
-    queues = []
+    specs = []
     for mem in val:
+        # Everything after the first ; are publish options
+        options = [part.strip() for part in mem.split(';')]
+        mem, options = options[0], [option for option in options[1:] if option]
+
+        # If there's a :, then the first part is the throttle as an int and
+        # the second part is the queue name
         if ':' in mem:
             mem = [part.strip() for part in mem.split(':')]
-            queues.append((int(mem[0]), mem[1]))
+            throttle, queue = int(mem[0]), mem[1]
         else:
-            queues.append((100, mem))
+            throttle, queue = 100, mem
+
+        specs.append((throttle, queue, parse_publish_policy(options)))
+
+    return specs
+
+
+def parse_queues(val):
+    """Takes a string and converts it to a list of (queuename, throttle) tuples
+
+    :arg str val: the configuration value
+
+    :returns: list of (throttle, queuename) tuples
+
+    """
+    return [(throttle, queue) for throttle, queue, policy in parse_queue_specs(val)]
+
 
-    return queues
+def parse_priorities(val):
+    """Takes a string and converts it to a list of (max age, priority) tuples
+
+    Buckets are comma separated and in the form ``MAXAGE:PRIORITY`` where
+    ``MAXAGE`` is the maximum crash age in days.
+
+    :arg str val: the configuration value
+
+    :returns: list of (max age in days, priority) tuples sorted by max age
+
+    :raises ValueError: if the value is malformed or has duplicate max ages
+
+    """
+    buckets = []
+    for mem in val.split(','):
+        mem = mem.strip()
+        if not mem:
+            continue
+        if ':' not in mem:
+            raise ValueError('%r is not a MAXAGE:PRIORITY bucket' % mem)
+        max_age, priority = [int(part.strip()) for part in mem.split(':', 1)]
+        if max_age < 0:
+            raise ValueError('%r is not a valid max age' % max_age)
+        if max_age in [bucket_max_age for bucket_max_age, bucket_priority in buckets]:
+            raise ValueError('%r: duplicate max age' % max_age)
+        if not 0 <= priority <= 255:
+            raise ValueError('%r is not a valid priority' % priority)
+        buckets.append((max_age, priority))
+
+    return sorted(buckets)
+
+
+# A route: the name to use in metrics and the list of (throttle, queuename,
+# PublishPolicy) tuples to publish to; queues of None means use PIGEON_QUEUE
+Route = namedtuple('Route', ['name', 'queues'])
+
+DEFAULT_ROUTES = [
+    # (bucket, prefix, route); a bucket of None matches any bucket
+    (None, 'v2/raw_crash/', Route(name='default', queues=None)),
+]
+
+
+def parse_routes(val):
+    """Takes a JSON string and converts it to a list of (bucket, prefix, route) tuples
+
+    The value is a JSON list of objects with these keys:
+
+    * ``name``: the name of the route used in metrics
+    * ``prefix``: the key prefix to match; this must end in ``/``
+    * ``bucket``: optional; the bucket to match; defaults to any bucket
+    * ``queues``: optional; a PIGEON_QUEUE style queue value; defaults to the
+      queues in PIGEON_QUEUE
+
+    :arg str val: the configuration value
+
+    :returns: list of (bucket, prefix, Route) tuples
+
+    :raises ValueError: if the value is malformed or has more than one route
+        for the same bucket and prefix
+
+    """
+    if not val.strip():
+        return DEFAULT_ROUTES
+
+    items = json.loads(val)
+    if not isinstance(items, list):
+        raise ValueError('%r is not a list of routes' % (items,))
+
+    routes = []
+    seen = set()
+    for item in items:
+        try:
+            name = item['name']
+            prefix = item['prefix']
+        except (KeyError, TypeError):
+            raise ValueError('%r is not a valid route' % (item,))
+
+        bucket = item.get('bucket')
+        queues = item.get('queues')
+        if (
+            not isinstance(name, str) or
+            not isinstance(prefix, str) or
+            not isinstance(bucket, (str, type(None))) or
+            not isinstance(queues, (str, type(None)))
+        ):
+            raise ValueError('%r is not a valid route' % (item,))
+
+        if prefix and not prefix.endswith('/'):
+            raise ValueError('%r: prefix must end in /' % prefix)
+
+        if (bucket, prefix) in seen:
+            raise ValueError('%r: duplicate route for bucket and prefix' % (item,))
+        seen.add((bucket, prefix))
+
+        if queues is not None:
+            queues = parse_queue_specs(queues)
+        routes.append((bucket, prefix, Route(name=name, queues=queues)))
+
+    return routes
+
+
+class Router(object):
+    """Matches (bucket, key) pairs against a compiled routing table
+
+    Routes are compiled into a trie of key path segments per bucket. Routes
+    for any bucket are folded into every bucket's trie, so matching a record
+    is one dict lookup for the bucket and one walk down the key segments. The
+    route with the longest matching prefix wins and a route for a specific
+    bucket beats a route for any bucket.
+
+    """
+    def __init__(self, routes):
+        self.routes = routes
+        self.default_trie = {}
+        self.tries = {}
+
+        any_bucket = [(prefix, route) for bucket, prefix, route in routes if bucket is None]
+        for prefix, route in any_bucket:
+            self._add(self.default_trie, prefix, route)
+
+        for bucket, prefix, route in routes:
+            if bucket is None:
+                continue
+            if bucket not in self.tries:
+                trie = self.tries[bucket] = {}
+                for any_prefix, any_route in any_bucket:
+                    self._add(trie, any_prefix, any_route)
+            self._add(self.tries[bucket], prefix, route)
+
+    def _add(self, trie, prefix, route):
+        node = trie
+        for part in prefix.split('/')[:-1]:
+            node = node.setdefault(part, {})
+        # None can't be a key path segment, so it holds the route
+        node[None] = route
+
+    def match(self, bucket, key):
+        """Returns the route for the given bucket and key
+
+        :arg str bucket: the bucket name
+        :arg str key: the object key
+
+        :returns: (route, object name) or (None, None) if no route matches
+
+        """
+        node = self.tries.get(bucket, self.default_trie)
+        route = node.get(None)
+        parts = key.split('/')
+        for part in parts[:-1]:
+            node = node.get(part)
+            if node is None:
+                break
+            route = node.get(None, route)
+
+        if route is None:
+            return None, None
+        return route, parts[-1]
 
 
 class Config(object):
@@ -97,7 +361,24 @@ class Config(object):
         self.host = self.get_from_env('HOST')
         self.port = int(self.get_from_env('PORT'))
         self.user = self.get_from_env('USER')
-        self.queues = parse_queues(self.get_from_env('QUEUE'))
+
+        self.queue_specs = parse_queue_specs(self.get_from_env('QUEUE'))
+        self.queues = [(throttle, queue) for throttle, queue, policy in self.queue_specs]
+
+        self.router = Router(parse_routes(self.get_from_env('ROUTES', '')))
+
+        self.log_mode = self.get_from_env('LOG_MODE', LOG_MODE_RECORD)
+        if self.log_mode not in (LOG_MODE_RECORD, LOG_MODE_SUMMARY):
+            raise ValueError('%r is not a valid log mode' % self.log_mode)
+        self.log_sample = int(self.get_from_env('LOG_SAMPLE', '0'))
+        if not 0 <= self.log_sample <= 100:
+            raise ValueError('%r is not a valid log sample' % self.log_sample)
+
+        self.priorities = parse_priorities(self.get_from_env('PRIORITIES', ''))
+
+        self.throttle_mode = self.get_from_env('THROTTLE_MODE', THROTTLE_MODE_RANDOM)
+        if self.throttle_mode not in (THROTTLE_MODE_RANDOM, THROTTLE_MODE_HASH):
+            raise ValueError('%r is not a valid throttle mode' % self.throttle_mode)
 
         self.aws_region = self.get_from_env('AWS_REGION', '')
 
@@ -136,9 +417,21 @@ class Config(object):
 
         Pass variable (lowercase) = value as args.
 
+        ``queues`` and ``queue_specs`` are kept in sync, so overriding one
+        overrides the other.
+
         """
         old_values = {}
 
+        if 'queues' in kwargs and 'queue_specs' not in kwargs:
+            kwargs['queue_specs'] = [
+                (throttle, queue, DEFAULT_PUBLISH_POLICY) for throttle, queue in kwargs['queues']
+            ]
+        elif 'queue_specs' in kwargs and 'queues' not in kwargs:
+            kwargs['queues'] = [
+                (throttle, queue) for throttle, queue, policy in kwargs['queue_specs']
+            ]
+
         for key, val in kwargs.items():
             if getattr(self, key, None) is not None:
                 old_values[key] = getattr(self, key)
@@ -154,9 +447,19 @@ CONFIG = Config()
 
 
 def statsd_incr(key, value=1, tags=None):
-    """Sends a specially formatted line for datadog to pick up for statsd incr"""
+    """Sends a specially formatted line for datadog to pick up for statsd incr
+
+    :arg str key: the metric key
+    :arg int value: the value to increment by
+    :arg list tags: optional list of "name:value" tags
+
+    """
+    tags = list(tags or [])
     if CONFIG.env:
-        tags = '#env:%s' % CONFIG.env
+        tags.insert(0, 'env:%s' % CONFIG.env)
+
+    if tags:
+        tags = '#' + ','.join(tags)
     else:
         tags = ''
 
@@ -197,37 +500,119 @@ def is_crash_id(crash_id):
     )
 
 
-def extract_crash_id_from_record(record):
-    """Given a record, extracts the crash id
+def route_record(record, bucket, log_record=True):
+    """Given a record, finds the matching route and extracts the crash id
 
     :arg dict record: the AWS event record
+    :arg str bucket: the bucket name from the record
+    :arg bool log_record: whether to emit log lines for this record
 
-    :returns: None (not a crash id) or the crash_id
+    :returns: (None, None) if no route matches or it's not a crash id or
+        (route, crash_id)
 
     """
     key = 'not extracted yet'
     try:
         key = record['s3']['object']['key']
-        logger.info('looking at key: %s', key)
-        if not key.startswith('v2/raw_crash/'):
-            logger.debug('%s: not a raw crash--ignoring', repr(key))
-            return None
-        crash_id = key.rsplit('/', 1)[-1]
+        if log_record:
+            logger.info('looking at key: %s', key)
+        route, crash_id = CONFIG.router.match(bucket, key)
+        if route is None:
+            if log_record:
+                logger.debug('%s: no route matches--ignoring', repr(key))
+            return None, None
         if not is_crash_id(crash_id):
-            logger.debug('%s: not a crash id--ignoring', repr(key))
-            return None
-        return crash_id
+            if log_record:
+                logger.debug('%s: not a crash id--ignoring', repr(key))
+            return None, None
+        return route, crash_id
     except (KeyError, IndexError) as exc:
-        logger.debug(
-            '%s: exception thrown when extracting crashid--ignoring: %s', repr(key), exc
-        )
+        if log_record:
+            logger.debug(
+                '%s: exception thrown when extracting crashid--ignoring: %s', repr(key), exc
+            )
+        return None, None
+
+
+def extract_crash_id_from_record(record):
+    """Given a record, extracts the crash id
+
+    :arg dict record: the AWS event record
+
+    :returns: None (not a crash id) or the crash_id
+
+    """
+    try:
+        bucket = record['s3']['bucket']['name']
+    except (KeyError, TypeError) as exc:
+        logger.debug('exception thrown when extracting bucket--ignoring: %s', exc)
         return None
+    return route_record(record, bucket)[1]
 
 
 def get_throttle_result(crash_id):
     return crash_id[-7]
 
 
+def get_crash_id_sample(crash_id):
+    """Returns a sampling value for the crash id between 0 and 99
+
+    Crash ids start with random hex digits, so this is a stable hash of the
+    crash id. It's the same across retries and for every queue.
+
+    :arg str crash_id: the crash id
+
+    :returns: int between 0 and 99
+
+    """
+    return int(crash_id[0:8], 16) % 100
+
+
+def get_crash_id_priority(crash_id, today, priorities):
+    """Returns the message priority for the crash id based on its age
+
+    :arg str crash_id: the crash id
+    :arg date today: the date to compute the crash's age from
+    :arg list priorities: list of (max age in days, priority) tuples sorted
+        by max age
+
+    :returns: the priority of the first bucket the crash's age fits in or 0
+        if it doesn't fit in any or the crash id date is invalid
+
+    """
+    date = crash_id[-6:]
+    try:
+        submitted = datetime.date(2000 + int(date[0:2]), int(date[2:4]), int(date[4:6]))
+    except ValueError:
+        return 0
+
+    age = (today - submitted).days
+    for max_age, priority in priorities:
+        if age <= max_age:
+            return priority
+    return 0
+
+
+def with_priority(properties, priority):
+    """Returns a copy of the pika.BasicProperties with the priority set"""
+    properties = copy.copy(properties)
+    properties.priority = priority
+    return properties
+
+
+def is_throttled(throttle, sample):
+    """Returns whether a crash with the given sampling value is throttled for a queue
+
+    :arg int throttle: the queue throttle between 0 (publish nothing) and 100
+        (publish everything)
+    :arg int sample: the sampling value for the crash
+
+    :returns: True if the crash should not be published to the queue
+
+    """
+    return throttle != 100 and throttle <= sample
+
+
 def build_pika_connection(host, port, virtual_host, user, password):
     """Build a pika (rabbitmq) connection"""
     return pika.BlockingConnection(
@@ -246,33 +631,119 @@ def build_pika_connection(host, port, virtual_host, user, password):
     )
 
 
+class InvocationStats(object):
+    """Collects counts, a sample of crash ids, and errors for an invocation summary"""
+    def __init__(self):
+        # Start with every count at 0 so every summary has the same fields
+        self.counts = Counter({key: 0 for key in SUMMARY_COUNTS})
+        self.crash_ids = []
+        self.errors = []
+
+    def add_crash_id(self, crash_id):
+        if len(self.crash_ids) < SUMMARY_CRASH_IDS:
+            self.crash_ids.append(crash_id)
+
+    def as_fields(self):
+        fields = dict(self.counts)
+        fields['crash_ids'] = self.crash_ids
+        fields['errors'] = self.errors
+        return fields
+
+
+def should_log_record(log_sample):
+    """Returns whether to emit per-record log lines for a record
+
+    :arg int log_sample: percent of records to log from 0 (none) to 100 (all)
+
+    :returns: True or False
+
+    """
+    if log_sample >= 100:
+        return True
+    return log_sample > 0 and random.random() * 100 < log_sample
+
+
 def handler(event, context):
+    stats = InvocationStats()
+    summary_mode = CONFIG.log_mode == LOG_MODE_SUMMARY
+    try:
+        publish_event(event, stats, log_sample=CONFIG.log_sample if summary_mode else 100)
+
+    except Exception as exc:
+        stats.errors.append('%s: %s' % (exc.__class__.__name__, exc))
+        raise
+
+    finally:
+        if summary_mode:
+            logger.info('invocation summary', extra=stats.as_fields())
+
+
+def publish_event(event, stats, log_sample=100):
+    """Publishes the crash ids in an S3 event to the queues for their routes
+
+    :arg dict event: the AWS event
+    :arg InvocationStats stats: collects counts for the invocation summary
+    :arg int log_sample: percent of records to emit per-record log lines for
+
+    """
     connection = None
 
     accepted_records = []
+    route_counts = Counter()
 
-    logger.info('number of records: %d', len(event['Records']))
+    priorities = CONFIG.priorities
+    today = datetime.datetime.utcnow().date()
+    # Priority by crash id date so it's only computed once per invocation
+    date_priorities = {}
+    priority_counts = Counter()
+
+    stats.counts['records'] = len(event['Records'])
+    if log_sample >= 100:
+        logger.info('number of records: %d', len(event['Records']))
     for record in event['Records']:
         # Skip anything that's not an S3 ObjectCreated:put event.
         if record['eventSource'] != 'aws:s3' or record['eventName'] != 'ObjectCreated:Put':
+            stats.counts['ignored'] += 1
             continue
 
-        # Extract bucket name for debugging.
+        # Extract bucket name for routing--a record without one is a bad event
         bucket = record['s3']['bucket']['name']
 
-        # Extract crash id--if it's not a raw_crash object, skip it.
-        crash_id = extract_crash_id_from_record(record)
+        log_record = should_log_record(log_sample)
+
+        # Route the record and extract crash id--if it's not a crash id for a
+        # route, skip it.
+        route, crash_id = route_record(record, bucket, log_record=log_record)
         if crash_id is None:
+            stats.counts['ignored'] += 1
             continue
 
-        logger.info('crash id: %s in %s', crash_id, bucket)
+        if log_record:
+            logger.info('crash id: %s in %s', crash_id, bucket)
+        route_counts[route.name] += 1
+        stats.add_crash_id(crash_id)
 
         # Skip crashes marked DEFER
         if get_throttle_result(crash_id) == DEFER:
             statsd_incr('socorro.pigeon.defer', value=1)
+            stats.counts['deferred'] += 1
             continue
 
-        accepted_records.append(crash_id)
+        priority = None
+        if priorities:
+            date = crash_id[-6:]
+            if date not in date_priorities:
+                date_priorities[date] = get_crash_id_priority(crash_id, today, priorities)
+            priority = date_priorities[date]
+            priority_counts[priority] += 1
+
+        accepted_records.append((route, crash_id, log_record, priority))
+
+    for route_name, count in route_counts.items():
+        statsd_incr('socorro.pigeon.route', value=count, tags=['route:%s' % route_name])
+
+    for priority, count in priority_counts.items():
+        statsd_incr('socorro.pigeon.priority', value=count, tags=['priority:%d' % priority])
 
     if not accepted_records:
         return
@@ -285,26 +756,54 @@ def handler(event, context):
             user=CONFIG.user,
             password=CONFIG.password,
         )
-        props = pika.BasicProperties(delivery_mode=2)
-
         channel = connection.channel()
 
-        for crash_id in accepted_records:
+        default_queues = CONFIG.queue_specs
+
+        hash_throttle = CONFIG.throttle_mode == THROTTLE_MODE_HASH
+
+        # Properties by (policy, priority) so they're only computed once per
+        # invocation
+        priority_properties = {}
+
+        for route, crash_id, log_record, priority in accepted_records:
             statsd_incr('socorro.pigeon.accept', value=1)
+            stats.counts['accepted'] += 1
+
+            # In hash mode, the crash is sampled once for all queues; in
+            # random mode, it's sampled for each throttled queue
+            sample = get_crash_id_sample(crash_id) if hash_throttle else None
+
+            queues = route.queues if route.queues is not None else default_queues
+            for throttle, queue, policy in queues:
+                if throttle != 100 and not hash_throttle:
+                    sample = random.randint(0, 100)
 
-            for throttle, queue in CONFIG.queues:
-                if throttle != 100 and throttle <= random.randint(0, 100):
-                    logger.info('%s: crash throttled (%s:%s)', crash_id, throttle, queue)
+                if is_throttled(throttle, sample):
+                    if log_record:
+                        logger.info('%s: crash throttled (%s:%s)', crash_id, throttle, queue)
                     statsd_incr('socorro.pigeon.throttled', value=1)
+                    stats.counts['throttled'] += 1
                     continue
 
-                logger.info('%s: publishing to %s', crash_id, queue)
+                properties = policy.properties
+                # Priorities set in the queue options win over crash age
+                # priorities
+                if priority is not None and properties.priority is None:
+                    key = (id(policy), priority)
+                    if key not in priority_properties:
+                        priority_properties[key] = with_priority(properties, priority)
+                    properties = priority_properties[key]
+
+                if log_record:
+                    logger.info('%s: publishing to %s', crash_id, queue)
                 channel.basic_publish(
-                    exchange='',
+                    exchange=policy.exchange,
                     routing_key=queue,
                     body=crash_id,
-                    properties=props
+                    properties=properties
                 )
+                stats.counts['published'] += 1
 
     except PIKA_EXCEPTIONS:
         # We've told the pika connection to retry a bunch, so if we hit this,
@@ -2,6 +2,7 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import logging
 import os
 import random
 import sys
@@ -133,6 +134,15 @@ class RabbitMQHelper:
             return body.decode('ascii')
         return None
 
+    def next_header(self, queue):
+        """Returns the properties of the next item in the queue"""
+        channel = self.conn.channel()
+        method_frame, header_frame, body = channel.basic_get(queue=queue)
+        if method_frame:
+            channel.basic_ack(delivery_tag=method_frame.delivery_tag)
+            return header_frame
+        return None
+
 
 @pytest.fixture
 def rabbitmq_helper():
@@ -152,3 +162,23 @@ def mock_randint_always_20():
     random.randint = mock_randint
     yield
     random.randint = old_randint
+
+
+class ListHandler(logging.Handler):
+    """Logging handler that keeps the records it handles in a list"""
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+@pytest.yield_fixture
+def pigeon_log_records():
+    """Returns the list of records logged by the pigeon logger during the test"""
+    handler = ListHandler()
+    logger = logging.getLogger('pigeon')
+    logger.addHandler(handler)
+    yield handler.records
+    logger.removeHandler(handler)
@@ -2,9 +2,27 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import datetime
+
+import pika
 import pytest
 
-from pigeon import CONFIG, extract_crash_id_from_record, parse_queues
+import pigeon
+from pigeon import (
+    CONFIG,
+    DEFAULT_PUBLISH_POLICY,
+    extract_crash_id_from_record,
+    get_crash_id_priority,
+    get_crash_id_sample,
+    is_throttled,
+    parse_queue_specs,
+    parse_priorities,
+    parse_queues,
+    parse_routes,
+    Router,
+    should_log_record,
+    statsd_incr,
+)
 
 
 def test_basic(client, rabbitmq_helper):
@@ -167,6 +185,13 @@ def test_extract_crash_id_from_record(data, expected, client):
     assert extract_crash_id_from_record(record) == expected
 
 
+def test_extract_crash_id_from_record_no_bucket(client):
+    crash_id = 'de1bb258-cbbf-4589-a673-34f800160918'
+    record = client.build_crash_save_events(client.crash_id_to_path(crash_id))['Records'][0]
+    del record['s3']['bucket']
+    assert extract_crash_id_from_record(record) is None
+
+
 @pytest.mark.parametrize('data, expected', [
     # Single queue as a string
     ('socorro.normal', [(100, 'socorro.normal')]),
@@ -181,3 +206,398 @@ def test_extract_crash_id_from_record(data, expected, client):
 ])
 def test_parse_queues(data, expected):
     assert parse_queues(data) == expected
+
+
+def test_parse_queues_drops_options():
+    assert (
+        parse_queues('socorro.normal;delivery_mode=1, 10:socorro.submitter;expiration=60000') ==
+        [(100, 'socorro.normal'), (10, 'socorro.submitter')]
+    )
+
+
+def test_parse_queue_specs_default_policy():
+    specs = parse_queue_specs('socorro.normal, 10:socorro.submitter')
+    assert specs == [
+        (100, 'socorro.normal', DEFAULT_PUBLISH_POLICY),
+        (10, 'socorro.submitter', DEFAULT_PUBLISH_POLICY),
+    ]
+
+
+def test_parse_queue_specs_options():
+    specs = parse_queue_specs(
+        'socorro.normal, '
+        '10:socorro.submitter; delivery_mode=transient; expiration=60000; priority=5; '
+        'exchange=sampling'
+    )
+    throttle, queue, policy = specs[1]
+    assert throttle == 10
+    assert queue == 'socorro.submitter'
+    assert policy.exchange == 'sampling'
+    assert policy.properties.delivery_mode == 1
+    assert policy.properties.expiration == '60000'
+    assert policy.properties.priority == 5
+
+
+def test_parse_queue_specs_same_queue():
+    # The same queue name can be published to on different exchanges
+    specs = parse_queue_specs('normal;exchange=a,normal;exchange=b')
+    assert [(queue, policy.exchange) for throttle, queue, policy in specs] == [
+        ('normal', 'a'), ('normal', 'b')
+    ]
+
+
+def test_override_queues():
+    # Overriding queues or queue_specs overrides the other, too
+    with CONFIG.override(queues=[(100, 'normal'), (15, 'submitter')]):
+        assert CONFIG.queue_specs == [
+            (100, 'normal', DEFAULT_PUBLISH_POLICY),
+            (15, 'submitter', DEFAULT_PUBLISH_POLICY),
+        ]
+
+    with CONFIG.override(queue_specs=parse_queue_specs('normal;delivery_mode=1,15:submitter')):
+        assert CONFIG.queues == [(100, 'normal'), (15, 'submitter')]
+
+    assert CONFIG.queues == [(throttle, queue) for throttle, queue, policy in CONFIG.queue_specs]
+
+
+@pytest.mark.parametrize('data', [
+    'socorro.normal;delivery_mode=3',
+    'socorro.normal;priority=256',
+    'socorro.normal;expiration=soon',
+    'socorro.normal;expiration=-5',
+    'socorro.normal;jimbob=1',
+    'socorro.normal;transient',
+])
+def test_parse_queue_specs_bad_options(data):
+    with pytest.raises(ValueError):
+        parse_queue_specs(data)
+
+
+def test_publish_policy(client, rabbitmq_helper):
+    queues = parse_queue_specs('normal,reprocessing;delivery_mode=1;expiration=60000')
+
+    with CONFIG.override(queue_specs=queues):
+        # Rebuild the connection using the overridden values
+        rabbitmq_helper.build_conn()
+
+        crash_id = 'de1bb258-cbbf-4589-a673-34f800160918'
+        events = client.build_crash_save_events(client.crash_id_to_path(crash_id))
+        assert client.run(events) is None
+
+        header_frame = rabbitmq_helper.next_header('normal')
+        assert header_frame.delivery_mode == 2
+        assert header_frame.expiration is None
+
+        header_frame = rabbitmq_helper.next_header('reprocessing')
+        assert header_frame.delivery_mode == 1
+        assert header_frame.expiration == '60000'
+
+
+def test_statsd_incr_tags(capsys):
+    with CONFIG.override(env='stage'):
+        statsd_incr('socorro.pigeon.route', value=5, tags=['route:default'])
+
+    stdout, stderr = capsys.readouterr()
+    assert '|5|count|socorro.pigeon.route|#env:stage,route:default\n' in stdout
+
+
+def test_parse_routes_default():
+    routes = parse_routes('')
+    assert [(bucket, prefix, route.name) for bucket, prefix, route in routes] == [
+        (None, 'v2/raw_crash/', 'default')
+    ]
+    assert routes[0][2].queues is None
+
+
+def test_parse_routes():
+    routes = parse_routes(
+        '[{"name": "prod", "bucket": "crashes-prod", "prefix": "v2/raw_crash/"}, '
+        '{"name": "v3", "prefix": "v3/raw_crash/", "queues": "normal,10:submitter"}]'
+    )
+    assert routes[0][0:2] == ('crashes-prod', 'v2/raw_crash/')
+    assert routes[0][2].name == 'prod'
+    assert routes[0][2].queues is None
+    assert routes[1][0:2] == (None, 'v3/raw_crash/')
+    assert routes[1][2].name == 'v3'
+    assert [(throttle, queue) for throttle, queue, policy in routes[1][2].queues] == [
+        (100, 'normal'), (10, 'submitter')
+    ]
+
+
+@pytest.mark.parametrize('data', [
+    '{"name": "prod"}',
+    '[{"name": "prod"}]',
+    '[{"name": "prod", "prefix": "v2/raw_crash"}]',
+    '[{"name": "prod", "prefix": 2}]',
+    '5',
+    'null',
+    '{"a": 1}',
+    '[{"name": "a", "prefix": "v2/raw_crash/"}, {"name": "b", "prefix": "v2/raw_crash/"}]',
+    '[{"name": "prod", "prefix": "v2/raw_crash/", "bucket": 2}]',
+    '[{"name": "prod", "prefix": "v2/raw_crash/", "queues": ["normal"]}]',
+    'not json',
+])
+def test_parse_routes_bad(data):
+    with pytest.raises(ValueError):
+        parse_routes(data)
+
+
+@pytest.mark.parametrize('bucket, key, expected', [
+    # Any bucket route
+    ('dev_bucket', 'v2/raw_crash/de1/20160918/crashid', ('v2', 'crashid')),
+    ('crashes-prod', 'v3/raw_crash/de1/20160918/crashid', ('v3', 'crashid')),
+
+    # Bucket route beats any bucket route with same prefix
+    ('crashes-prod', 'v2/raw_crash/de1/20160918/crashid', ('prod', 'crashid')),
+
+    # Longest prefix wins
+    ('dev_bucket', 'v2/raw_crash/test/20160918/crashid', ('test', 'crashid')),
+
+    # No matching route
+    ('dev_bucket', 'v1/dump_names/crashid', (None, None)),
+    ('dev_bucket', 'v2/raw_crash', (None, None)),
+    ('dev_bucket', 'foo/bar/test', (None, None)),
+])
+def test_router_match(bucket, key, expected):
+    router = Router(parse_routes(
+        '[{"name": "v2", "prefix": "v2/raw_crash/"}, '
+        '{"name": "v3", "prefix": "v3/raw_crash/"}, '
+        '{"name": "test", "prefix": "v2/raw_crash/test/"}, '
+        '{"name": "prod", "bucket": "crashes-prod", "prefix": "v2/raw_crash/"}]'
+    ))
+    route, name = router.match(bucket, key)
+    assert (route.name if route else None, name) == expected
+
+
+def test_routing(client, rabbitmq_helper, capsys):
+    queues = parse_queue_specs('normal,v3normal')
+    router = Router(parse_routes(
+        '[{"name": "v2", "prefix": "v2/raw_crash/"}, '
+        '{"name": "v3", "prefix": "v3/raw_crash/", "queues": "v3normal"}]'
+    ))
+
+    with CONFIG.override(queue_specs=queues, router=router):
+        # Rebuild the connection using the overridden values
+        rabbitmq_helper.build_conn()
+
+        v2_crash_id = 'de1bb258-cbbf-4589-a673-34f800160918'
+        v3_crash_id = 'de1bb258-cbbf-4589-a673-34f800160919'
+        events = client.build_crash_save_events([
+            client.crash_id_to_path(v2_crash_id),
+            client.crash_id_to_path(v3_crash_id).replace('v2/', 'v3/'),
+        ])
+        # PIGEON_QUEUE queues are used for routes without queues
+        with CONFIG.override(queue_specs=parse_queue_specs('normal')):
+            assert client.run(events) is None
+
+        assert rabbitmq_helper.next_item('normal') == v2_crash_id
+        assert rabbitmq_helper.next_item('normal') is None
+        assert rabbitmq_helper.next_item('v3normal') == v3_crash_id
+
+        stdout, stderr = capsys.readouterr()
+        assert '|1|count|socorro.pigeon.route|#env:test,route:v2\n' in stdout
+        assert '|1|count|socorro.pigeon.route|#env:test,route:v3\n' in stdout
+
+
+def test_should_log_record():
+    assert should_log_record(100) is True
+    assert all(not should_log_record(0) for i in range(100))
+
+
+def test_record_log_mode(client, pigeon_log_records):
+    crash_id = 'de1bb258-cbbf-4589-a673-34f801160918'
+    #                                        ^ defer
+    events = client.build_crash_save_events(client.crash_id_to_path(crash_id))
+    assert client.run(events) is None
+
+    messages = [record.getMessage() for record in pigeon_log_records]
+    assert 'crash id: %s in dev_bucket' % crash_id in messages
+    assert 'invocation summary' not in messages
+
+
+@pytest.mark.parametrize('key, value', [
+    ('PIGEON_LOG_MODE', 'jimbob'),
+    ('PIGEON_LOG_SAMPLE', '-5'),
+    ('PIGEON_LOG_SAMPLE', '500'),
+])
+def test_bad_log_config(key, value, monkeypatch):
+    monkeypatch.setenv(key, value)
+    with pytest.raises(ValueError):
+        pigeon.Config()
+
+
+def test_summary_log_mode(client, pigeon_log_records):
+    crash_id = 'de1bb258-cbbf-4589-a673-34f801160918'
+    #                                        ^ defer
+    events = client.build_crash_save_events([
+        client.crash_id_to_path(crash_id),
+        'v1/dump_names/de1bb258-cbbf-4589-a673-34f801160918',
+    ])
+
+    with CONFIG.override(log_mode='summary', log_sample=0):
+        assert client.run(events) is None
+
+    # Per-record lines are skipped and there's one summary line
+    assert [record.getMessage() for record in pigeon_log_records] == ['invocation summary']
+    summary = pigeon_log_records[0]
+    assert summary.records == 2
+    assert summary.ignored == 1
+    assert summary.deferred == 1
+
+    # Counts that weren't incremented are still there
+    assert summary.accepted == 0
+    assert summary.throttled == 0
+    assert summary.published == 0
+    assert summary.crash_ids == [crash_id]
+    assert summary.errors == []
+
+
+def test_summary_log_mode_sampling(client, pigeon_log_records):
+    crash_id = 'de1bb258-cbbf-4589-a673-34f801160918'
+    #                                        ^ defer
+    events = client.build_crash_save_events(client.crash_id_to_path(crash_id))
+
+    with CONFIG.override(log_mode='summary', log_sample=100):
+        assert client.run(events) is None
+
+    messages = [record.getMessage() for record in pigeon_log_records]
+    assert 'crash id: %s in dev_bucket' % crash_id in messages
+    assert messages[-1] == 'invocation summary'
+
+
+def test_summary_log_mode_errors(client, pigeon_log_records):
+    crash_id = 'de1bb258-cbbf-4589-a673-34f800160918'
+    events = client.build_crash_save_events(client.crash_id_to_path(crash_id))
+
+    # Remove the bucket bits so pigeon kicks up an error
+    del events['Records'][0]['s3']['bucket']
+
+    with CONFIG.override(log_mode='summary', log_sample=0):
+        with pytest.raises(KeyError):
+            client.run(events)
+
+    summary = pigeon_log_records[-1]
+    assert summary.getMessage() == 'invocation summary'
+    assert summary.errors == ["KeyError: 'bucket'"]
+
+
+def test_get_crash_id_sample():
+    crash_id = 'de1bb258-cbbf-4589-a673-34f800160918'
+    # 0xde1bb258 % 100
+    assert get_crash_id_sample(crash_id) == 80
+    assert get_crash_id_sample('00000000-cbbf-4589-a673-34f800160918') == 0
+
+
+@pytest.mark.parametrize('throttle, sample, expected', [
+    (100, 0, False),
+    (100, 100, False),
+    (100, None, False),
+    (15, 14, False),
+    (15, 15, True),
+    (15, 20, True),
+    (0, 0, True),
+])
+def test_is_throttled(throttle, sample, expected):
+    assert is_throttled(throttle, sample) == expected
+
+
+def test_hash_queue_throttling(client, rabbitmq_helper, mock_randint_always_20):
+    queues = parse_queue_specs('normal,81:submitter,80:devnull')
+
+    with CONFIG.override(queue_specs=queues, throttle_mode='hash'):
+        # Rebuild the connection using the overridden values
+        rabbitmq_helper.build_conn()
+
+        # Create a crash_id event and run pigeon--the crash id sample is 80
+        crash_id = 'de1bb258-cbbf-4589-a673-34f800160918'
+        events = client.build_crash_save_events(client.crash_id_to_path(crash_id))
+        assert client.run(events) is None
+
+        # Verify the crash_id shows up in queues with a throttle over 80
+        assert rabbitmq_helper.next_item('normal') == crash_id
+        assert rabbitmq_helper.next_item('submitter') == crash_id
+        assert rabbitmq_helper.next_item('devnull') is None
+
+
+@pytest.mark.parametrize('data, expected', [
+    ('', []),
+    ('1:10', [(1, 10)]),
+    (' 30:1, 1:10 ,7:5 ', [(1, 10), (7, 5), (30, 1)]),
+])
+def test_parse_priorities(data, expected):
+    assert parse_priorities(data) == expected
+
+
+@pytest.mark.parametrize('data', ['10', '1:256', 'a:1', '-1:3', '1:10,1:5'])
+def test_parse_priorities_bad(data):
+    with pytest.raises(ValueError):
+        parse_priorities(data)
+
+
+@pytest.mark.parametrize('crash_id, expected', [
+    # Today, yesterday, and the future
+    ('de1bb258-cbbf-4589-a673-34f800160918', 10),
+    ('de1bb258-cbbf-4589-a673-34f800160917', 10),
+    ('de1bb258-cbbf-4589-a673-34f800160920', 10),
+
+    # 2 to 7 days old
+    ('de1bb258-cbbf-4589-a673-34f800160916', 5),
+    ('de1bb258-cbbf-4589-a673-34f800160911', 5),
+
+    # Older than the oldest bucket
+    ('de1bb258-cbbf-4589-a673-34f800160910', 0),
+
+    # Invalid date
+    ('de1bb258-cbbf-4589-a673-34f800161318', 0),
+])
+def test_get_crash_id_priority(crash_id, expected):
+    today = datetime.date(2016, 9, 18)
+    assert get_crash_id_priority(crash_id, today, [(1, 10), (7, 5)]) == expected
+
+
+def test_priority(client, rabbitmq_helper, capsys):
+    queues = parse_queue_specs('normal,submitter;priority=1')
+
+    with CONFIG.override(queue_specs=queues, priorities=[(1, 10), (7, 5)]):
+        # Rebuild the connection using the overridden values
+        rabbitmq_helper.build_conn()
+
+        # Fresh crash and an old crash
+        today = datetime.datetime.utcnow().strftime('%y%m%d')
+        fresh_crash_id = 'de1bb258-cbbf-4589-a673-34f800' + today
+        old_crash_id = 'de1bb258-cbbf-4589-a673-34f800160918'
+        events = client.build_crash_save_events([
+            client.crash_id_to_path(fresh_crash_id),
+            client.crash_id_to_path(old_crash_id),
+        ])
+        assert client.run(events) is None
+
+        assert rabbitmq_helper.next_header('normal').priority == 10
+        assert rabbitmq_helper.next_header('normal').priority == 0
+
+        # Priorities in queue options win
+        assert rabbitmq_helper.next_header('submitter').priority == 1
+        assert rabbitmq_helper.next_header('submitter').priority == 1
+
+        stdout, stderr = capsys.readouterr()
+        assert '|1|count|socorro.pigeon.priority|#env:test,priority:10\n' in stdout
+        assert '|1|count|socorro.pigeon.priority|#env:test,priority:0\n' in stdout
+
+
+def test_priority_metrics_on_publish_error(client, capsys, monkeypatch):
+    def build_broken_connection(**kwargs):
+        raise pika.exceptions.AMQPConnectionError()
+
+    monkeypatch.setattr(pigeon, 'build_pika_connection', build_broken_connection)
+
+    today = datetime.datetime.utcnow().strftime('%y%m%d')
+    crash_id = 'de1bb258-cbbf-4589-a673-34f800' + today
+    events = client.build_crash_save_events(client.crash_id_to_path(crash_id))
+
+    # Connecting fails, but the priority metrics are emitted before that
+    with CONFIG.override(priorities=[(1, 10)]):
+        with pytest.raises(pika.exceptions.AMQPConnectionError):
+            client.run(events)
+
+    stdout, stderr = capsys.readouterr()
+    assert '|1|count|socorro.pigeon.priority|#env:test,priority:10\n' in stdout